@@ -0,0 +1,147 @@
+"""
+Benchmark throughput of the gunicorn deployment for a growing number of
+worker processes.
+
+    python bench_workers.py --workers 1 2 4 --duration 10
+
+Every run starts `gunicorn app:app` with gunicorn.conf.py against the
+PROD_* database and drives it with as many client processes as
+--clients, each requesting /categories and /quizzes in a loop.
+
+The server and the clients are pinned to separate CPUs (--client-cpus
+of them go to the clients) so that the clients don't take cores away
+from the workers. Worker counts above the number of server CPUs
+measure oversubscription, not per-core scaling. On a machine with a
+single CPU nothing can be separated and the numbers are only
+indicative; use a bigger machine or drive the server from another host.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+QUIZ_BODY = json.dumps({
+    'previous_questions': [],
+    'quiz_category': {'type': 'All', 'id': 0}
+})
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', '/categories')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def run_client(port, duration):
+    """
+    Send requests until duration has elapsed, return the number of
+    successful requests
+    """
+    completed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        if completed % 2:
+            connection.request('GET', '/categories')
+        else:
+            connection.request('POST', '/quizzes', QUIZ_BODY,
+                               {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        if response.status == 200:
+            completed += 1
+    return completed
+
+
+def split_cpus(client_cpus):
+    """
+    Split the available CPUs into (server CPUs, client CPUs), or return
+    None when there aren't enough CPUs to keep them apart
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if client_cpus < 1 or len(cpus) <= client_cpus:
+        return None
+    return set(cpus[:-client_cpus]), set(cpus[-client_cpus:])
+
+
+def pin(cpus):
+    os.sched_setaffinity(0, cpus)
+
+
+def benchmark(workers, clients, duration, port, cpus):
+    server_cpus, client_cpus = cpus or (None, None)
+    # a snapshot of its own, so a live server on this host isn't affected
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        env = dict(os.environ, SNAPSHOT_PATH=os.path.join(snapshot_dir,
+                                                          'trivia.snapshot'))
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+             '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+             '--log-level', 'warning', 'app:app'],
+            cwd=BASEDIR, env=env,
+            preexec_fn=(lambda: pin(server_cpus)) if cpus else None)
+        try:
+            wait_until_ready(port)
+            with multiprocessing.Pool(
+                    clients, initializer=pin if cpus else None,
+                    initargs=(client_cpus,) if cpus else ()) as pool:
+                completed = pool.starmap(run_client,
+                                         [(port, duration)] * clients)
+        finally:
+            server.terminate()
+            server.wait()
+    return sum(completed) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, nargs='+')
+    parser.add_argument('--client-cpus', type=int,
+                        default=max(1, len(os.sched_getaffinity(0)) // 4),
+                        help='CPUs reserved for the client processes')
+    parser.add_argument('--clients', type=int,
+                        help='client processes, 2 per client CPU by default')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    cpus = split_cpus(args.client_cpus)
+    if cpus is None:
+        print('warning: not enough CPUs to pin the server and the clients '
+              'apart, results are only indicative', file=sys.stderr)
+        server_cpu_count = len(os.sched_getaffinity(0))
+    else:
+        server_cpu_count = len(cpus[0])
+        print(f'server CPUs {sorted(cpus[0])}, client CPUs {sorted(cpus[1])}')
+    clients = args.clients or 2 * args.client_cpus
+    workers_counts = args.workers or [
+        count for count in [1, 2, 4, 8, 16, 32] if count < server_cpu_count
+    ] + [server_cpu_count]
+
+    print(f"{'workers':>8} {'req/s':>10} {'req/s/worker':>14} {'scaling':>8}")
+    baseline = None
+    for workers in sorted(set(workers_counts)):
+        throughput = benchmark(workers, clients, args.duration,
+                               args.port, cpus)
+        baseline = baseline or throughput
+        print(f'{workers:>8} {throughput:>10.1f} '
+              f'{throughput / workers:>14.1f} {throughput / baseline:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 import random
 from flask import Flask, request, abort, jsonify
 from flask_cors import CORS
-from sqlalchemy import exc
+from sqlalchemy import exc, func
 
-from .models import setup_db, Question, Category
+from .models import (setup_db, db, Question, Category, LOADING_STRATEGIES,
+                     load_first_questions)
 from .config import ProductionConfig
+from .cache import search_cache
+from .snapshot import snapshot
 
 QUESTIONS_PER_PAGE = 10
 
@@ -14,16 +17,66 @@ def paginate(request, selection):
     start = (page - 1) * QUESTIONS_PER_PAGE
     end = start + QUESTIONS_PER_PAGE
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+    current_questions = [question.format()
+                         for question in selection[start:end]]
 
     return current_questions
 
 
+def get_flag(request, name):
+    """
+    Get a boolean query parameter such as ?name=1, ?name=true or ?name=no
+    """
+    value = request.args.get(name, '0').strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off', ''):
+        return False
+    abort(400)
+
+
+def build_snapshot():
+    """
+    Build the worker snapshot from the database. The data is read while
+    holding the snapshot lock, so a rebuild that started before another
+    worker's write can't replace the snapshot written after it.
+    """
+    with snapshot.locked():
+        snapshot.build(Category.query.order_by(Category.id).all(),
+                       Question.query.order_by(Question.id).all())
+
+
+def publish_question_changes(logger):
+    """
+    Bump the write generation and rebuild the snapshot after questions
+    changed. The write is already committed, so a failed rebuild only
+    drops the snapshot: every worker falls back to the database and the
+    rebuild is retried after the next request, as the snapshot stays stale.
+    """
+    with snapshot.locked() as lock_fd:
+        if snapshot.changed:
+            snapshot.bump_generation(lock_fd)
+        try:
+            snapshot.build(Category.query.order_by(Category.id).all(),
+                           Question.query.order_by(Question.id).all())
+        except Exception:
+            logger.exception('Could not rebuild the snapshot')
+            snapshot.discard()
+
+
 def create_app(test_config=ProductionConfig()):
     # create and configure the app
     app = Flask(__name__)
     setup_db(app, test_config)
+    if app.config['CATEGORY_QUESTIONS_LOADING'] not in LOADING_STRATEGIES:
+        raise ValueError('CATEGORY_QUESTIONS_LOADING must be one of ' +
+                         ', '.join(LOADING_STRATEGIES))
+    search_cache.configure(app.config['SEARCH_CACHE_SIZE'])
+    snapshot.configure(app.config['SNAPSHOT_PATH'])
+    if snapshot.path is not None:
+        # warm before any worker is forked or accepts traffic
+        with app.app_context():
+            build_snapshot()
 
     """
     Set up CORS. Allow '*' for origins.
@@ -41,23 +94,99 @@ def create_app(test_config=ProductionConfig()):
                              'GET, POST, PUT, PATCH, DELETE, OPTIONS')
         return response
 
+    @app.before_request
+    def refresh_snapshot():
+        """
+        Pick up questions written and snapshots rebuilt by other workers
+        """
+        if snapshot.refresh():
+            search_cache.clear()
+
+    @app.after_request
+    def rebuild_snapshot(response):
+        """
+        Publish question changes of this worker to the other workers
+        """
+        if snapshot.path is not None and snapshot.stale:
+            try:
+                publish_question_changes(app.logger)
+            except OSError:
+                app.logger.exception('Could not lock the snapshot')
+        return response
+
+    def get_category_map():
+        """
+        Get the id: type map of all categories
+        """
+        if snapshot.ready:
+            return snapshot.categories()
+        return {category.id: category.type
+                for category in Category.query.all()}
+
+    def get_categories_with_questions(with_counts, with_sample):
+        """
+        Get categories with their question counts and sample questions,
+        using one grouped query for the counts and loading only the sample
+        questions into Category.questions
+        """
+        query = Category.query.order_by(Category.id)
+        if with_sample:
+            options = load_first_questions(
+                app.config['CATEGORY_QUESTIONS_LOADING'], with_sample)
+            # replace questions already loaded in the session by the sample
+            query = query.options(*options).execution_options(
+                populate_existing=True)
+        categories = query.all()
+        if (len(categories) == 0):
+            abort(404)
+
+        response = {
+            'success': True,
+            'categories': {
+                category.id: category.type for category in categories},
+            'total_categories': len(categories)
+        }
+        if with_counts:
+            counts = dict(db.session.query(
+                Question.category, func.count(Question.id)).group_by(
+                Question.category))
+            response['question_counts'] = {
+                category.id: counts.get(category.id, 0)
+                for category in categories}
+        if with_sample:
+            response['sample_questions'] = {
+                category.id: [question.format()
+                              for question in category.questions]
+                for category in categories}
+        return jsonify(response)
+
     @app.route('/categories', methods=['GET'])
     def get_categories():
         """
         Create an endpoint to handle GET requests for all available categories.
+        With ?with_counts=1 and/or ?with_sample=N also return the number of
+        questions and the first N questions of every category.
         """
+        with_counts = get_flag(request, 'with_counts')
         try:
-            categories = Category.query.all()
-            if (len(categories) == 0):
-                abort(404)
+            with_sample = int(request.args.get('with_sample', 0))
+        except ValueError:
+            abort(400)
+        if with_sample < 0:
+            abort(400)
 
-            formatted_categories = {
-                category.id: category.type for category in categories}
+        try:
+            if with_counts or with_sample:
+                return get_categories_with_questions(with_counts, with_sample)
+
+            formatted_categories = get_category_map()
+            if (len(formatted_categories) == 0):
+                abort(404)
 
             return jsonify({
                 'success': True,
                 'categories': formatted_categories,
-                'total_categories': len(Category.query.all())
+                'total_categories': len(formatted_categories)
             })
 
         except exc.SQLAlchemyError as e:
@@ -77,15 +206,12 @@ def create_app(test_config=ProductionConfig()):
         if (len(current_questions) == 0):
             abort(404)
 
-        categories = {
-            category.id: category.type for category in Category.query.all()}
-        current_categories = list(set([q.category for q in selection])).sort()
         return jsonify({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(Question.query.all()),
-            'current_category': current_categories,
-            'categories': categories
+            'total_questions': len(selection),
+            'current_category': None,
+            'categories': get_category_map()
         })
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
@@ -103,7 +229,7 @@ def create_app(test_config=ProductionConfig()):
         return jsonify({
             'success': True,
             'question': question_id,
-            'total_questions': len(Question.query.all()),
+            'total_questions': Question.query.count(),
             'current_category': question.category
         })
 
@@ -125,17 +251,32 @@ def create_app(test_config=ProductionConfig()):
             question.insert()
             selection = Question.query.order_by(Question.id).all()
             questions = paginate(request, selection)
-            current_categories = list(
-                set([q.category for q in selection])).sort()
             return jsonify({
                 'success': True,
                 'questions': questions,
-                'current_category': current_categories,
-                'total_questions': len(Question.query.all())
+                'current_category': None,
+                'total_questions': len(selection)
             })
         except Exception:
             abort(422)
 
+    def search_question_ids(search_term, page):
+        """
+        Get the ids of the questions matching search_term on the given page
+        and the total number of matches, using the search cache
+        """
+        key = search_cache.make_key(search_term, page)
+        generation = search_cache.generation
+        result = search_cache.get(key)
+        if result is None:
+            ids = [id for (id,) in db.session.query(Question.id).filter(
+                Question.question.ilike(f'%{search_term}%')).order_by(
+                Question.id)]
+            start = (page - 1) * QUESTIONS_PER_PAGE
+            result = (ids[start:start + QUESTIONS_PER_PAGE], len(ids))
+            search_cache.set(key, result, generation)
+        return result
+
     @app.route('/questions/search', methods=['POST'])
     def search_questions():
         """
@@ -145,23 +286,35 @@ def create_app(test_config=ProductionConfig()):
         search_term = body.get('searchTerm')
 
         if search_term is not None:
-            selection = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
-            current_questions = paginate(request, selection)
+            page = request.args.get('page', 1, type=int)
+            question_ids, total_questions = search_question_ids(
+                search_term, page)
 
-            if (len(current_questions) == 0):
+            if (len(question_ids) == 0):
                 abort(404)
-            current_categories = list(
-                set([q.category for q in selection])).sort()
+            current_questions = [question.format() for question in
+                                 Question.query.filter(
+                                     Question.id.in_(question_ids)).order_by(
+                                     Question.id)]
             return jsonify({
                 'success': True,
                 'questions': current_questions,
-                'current_category': current_categories,
-                'total_questions': len(selection)
+                'current_category': None,
+                'total_questions': total_questions
             })
 
         abort(422)
 
+    @app.route('/questions/search/stats', methods=['GET'])
+    def search_cache_stats():
+        """
+        Get hit ratio and memory usage of the search cache
+        """
+        return jsonify({
+            'success': True,
+            'stats': search_cache.stats()
+        })
+
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
     def get_questions_by_category(category_id):
         """
@@ -204,6 +357,19 @@ def create_app(test_config=ProductionConfig()):
 
         return questions[random.randrange(0, len(questions))]
 
+    def get_random_question_json(category, previous_questions):
+        """
+        Get the pre-serialized JSON of a random question from the snapshot
+        """
+        previous = set(previous_questions)
+        question_ids = [id for id in snapshot.question_ids(category)
+                        if id not in previous]
+
+        if len(question_ids) == 0:
+            return None
+
+        return snapshot.question_json(random.choice(question_ids))
+
     @app.route('/quizzes', methods=['POST'])
     def play_quiz():
         """
@@ -213,6 +379,17 @@ def create_app(test_config=ProductionConfig()):
         previous_questions = body.get('previous_questions')
         quiz_category = body.get('quiz_category')
 
+        if snapshot.ready:
+            question = get_random_question_json(quiz_category['id'],
+                                                previous_questions)
+            if question is not None:
+                return app.response_class(
+                    b'{"question":' + question + b',"success":true}\n',
+                    mimetype='application/json')
+            return jsonify({
+                'success': True
+            })
+
         question = get_random_question(quiz_category['id'], previous_questions)
 
         if question is None:
@@ -0,0 +1,153 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+class FrequencySketch:
+    """
+    Approximate access counts (count-min sketch) with periodic aging,
+    used as the TinyLFU admission filter.
+    """
+
+    DEPTH = 4
+
+    def __init__(self, width, sample_size):
+        self.width = max(width, 16)
+        self.sample_size = max(sample_size, 1)
+        self.additions = 0
+        self.rows = [[0] * self.width for _ in range(self.DEPTH)]
+
+    def _indexes(self, key):
+        h = hash(key)
+        for depth in range(self.DEPTH):
+            yield depth, hash((h, depth)) % self.width
+
+    def increment(self, key):
+        for depth, index in self._indexes(key):
+            self.rows[depth][index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def frequency(self, key):
+        return min(self.rows[depth][index]
+                   for depth, index in self._indexes(key))
+
+    def reset(self):
+        """
+        Halve every counter so that old popularity fades out
+        """
+        for row in self.rows:
+            for index in range(self.width):
+                row[index] >>= 1
+        self.additions //= 2
+
+    def clear(self):
+        self.additions = 0
+        for row in self.rows:
+            for index in range(self.width):
+                row[index] = 0
+
+
+class SearchCache:
+    """
+    Bounded cache of search results with LRU eviction and TinyLFU
+    admission: when the cache is full a new entry is only admitted if it
+    has been requested more often than the entry it would evict.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.configure(maxsize)
+
+    def configure(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self.entries = OrderedDict()
+            self.generation += 1
+            self.sketch = FrequencySketch(width=maxsize * 4,
+                                          sample_size=maxsize * 10)
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.rejections = 0
+            self.invalidations = 0
+
+    @staticmethod
+    def make_key(search_term, page):
+        # ILIKE is case-insensitive, so terms differing only by case
+        # share a result
+        return (search_term.lower(), page)
+
+    def get(self, key):
+        if self.maxsize <= 0:
+            return None
+        with self.lock:
+            self.sketch.increment(key)
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation):
+        """
+        Store value unless the cache was cleared since generation was read,
+        in which case value may predate a write
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+                return
+            if len(self.entries) >= self.maxsize:
+                victim = next(iter(self.entries))
+                if (self.sketch.frequency(key) <=
+                        self.sketch.frequency(victim)):
+                    self.rejections += 1
+                    return
+                del self.entries[victim]
+                self.evictions += 1
+            self.entries[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def memory_usage(self):
+        """
+        Approximate size in bytes of the cached keys and id lists
+        """
+        size = sys.getsizeof(self.entries)
+        for key, (ids, total) in self.entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(key[0])
+            size += sys.getsizeof(ids) + sys.getsizeof(total)
+            size += sum(sys.getsizeof(id) for id in ids)
+        return size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'invalidations': self.invalidations,
+                'memory_bytes': self.memory_usage()
+            }
+
+
+search_cache = SearchCache()
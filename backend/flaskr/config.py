@@ -24,6 +24,13 @@ class Config:
     TESTING = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = get_database_path("PROD")
+    # Maximum number of (search term, page) results kept in memory
+    SEARCH_CACHE_SIZE = 1024
+    # Memory-mapped snapshot shared by the worker processes, None disables it
+    SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+    # How Category.questions is loaded with categories: select, joined or
+    # selectin
+    CATEGORY_QUESTIONS_LOADING = 'selectin'
 
 
 # Creates a ProductionConfig object that can be used to configure the production environment
@@ -41,3 +48,4 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = get_database_path("TEST")
+    SNAPSHOT_PATH = None
@@ -1,8 +1,15 @@
 import os
-from sqlalchemy import Column, String, Integer
+from itertools import chain
+from sqlalchemy import (Column, String, Integer, ForeignKey, event, func,
+                        select)
+from sqlalchemy.orm import (Session, relationship, joinedload, lazyload,
+                            selectinload, with_loader_criteria)
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 
+from .cache import search_cache
+from .snapshot import snapshot
+
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
@@ -33,7 +40,7 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -73,6 +80,8 @@ class Category(db.Model):
 
     id = Column(Integer, primary_key=True)
     type = Column(String)
+    questions = relationship('Question', backref='question_category',
+                             order_by='Question.id', lazy='select')
 
     def __init__(self, type):
         self.type = type
@@ -82,3 +91,79 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+"""
+Loading strategies for Category.questions
+"""
+
+LOADING_STRATEGIES = {
+    'select': lazyload,
+    'joined': joinedload,
+    'selectin': selectinload
+}
+
+
+def load_questions(strategy):
+    """
+    Get the query option loading Category.questions with the given strategy
+    """
+    return LOADING_STRATEGIES[strategy](Category.questions)
+
+
+def load_first_questions(strategy, limit):
+    """
+    Get the query options loading only the first limit questions of every
+    category into Category.questions, picked in the database with
+    row_number() over each category
+    """
+    numbered = select(
+        Question.id,
+        func.row_number().over(partition_by=Question.category,
+                               order_by=Question.id).label('position')
+    ).subquery()
+    first_ids = select(numbered.c.id).where(numbered.c.position <= limit)
+    return [load_questions(strategy),
+            with_loader_criteria(Question, Question.id.in_(first_ids))]
+
+
+"""
+Cache invalidation
+"""
+
+
+def mark_questions_changed(session):
+    """
+    Drop cached search results now and again once the transaction ends,
+    so nothing read mid-transaction outlives a commit or rollback
+    """
+    session.info['questions_changed'] = True
+    search_cache.clear()
+
+
+@event.listens_for(Session, 'after_flush')
+def after_flush(session, flush_context):
+    if any(isinstance(obj, Question) for obj in
+           chain(session.new, session.dirty, session.deleted)):
+        mark_questions_changed(session)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def after_bulk_write(orm_execute_state):
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete) and
+            Question.__mapper__ in orm_execute_state.all_mappers):
+        mark_questions_changed(orm_execute_state.session)
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    if session.info.pop('questions_changed', False):
+        search_cache.clear()
+        # SQL can't be emitted here, the app rebuilds it after the request
+        snapshot.mark_changed()
+
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(session):
+    if session.info.pop('questions_changed', False):
+        search_cache.clear()
@@ -0,0 +1,270 @@
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+
+MAGIC = b'TRV2'
+# magic, number of questions, number of categories with questions,
+# size of the category map JSON
+HEADER = struct.Struct('=4s4xqqq')
+ITEM = struct.Struct('=q')
+
+
+class Snapshot:
+    """
+    Read-only, memory-mapped snapshot of the category map, the question
+    ids of every category and the pre-serialized questions.
+
+    The file is built once before the workers are forked, so every worker
+    maps the same pages instead of holding its own copy. The id lists and
+    the offset index are fixed-width int64 arrays read in place through
+    memoryviews; only the small category map is parsed into a dict.
+    After a write the snapshot is rebuilt and replaced atomically; the
+    other workers pick up the new file on their next request.
+
+    The lock file also holds a write generation, bumped on every question
+    write whether or not the rebuild succeeds, so the other workers know
+    to drop their search caches even while there is no snapshot.
+
+    File layout, every array 8-byte aligned:
+
+        header
+        question ids, sorted                        n x int64
+        body offsets of those questions             (n + 1) x int64
+        category ids, sorted                        m x int64
+        start of each category in the array below   (m + 1) x int64
+        question ids grouped by category            g x int64
+        category map JSON, padded
+        question JSON bodies
+
+    g is the last category start: questions without a category are not
+    grouped, so g can be smaller than n.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.state = None
+        self.file_id = None
+        self.stale = False
+        self.changed = False
+        self.generation_fd = None
+        self.generation = 0
+
+    def configure(self, path):
+        self.path = path
+        self.state = None
+        self.file_id = None
+        self.stale = False
+        self.changed = False
+        if self.generation_fd is not None:
+            os.close(self.generation_fd)
+        self.generation_fd = None
+        self.generation = 0
+
+    def mark_changed(self):
+        """
+        Record that questions were written, so the generation is bumped
+        and the snapshot rebuilt after the request
+        """
+        self.stale = True
+        self.changed = True
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold an exclusive lock shared by every process using the snapshot,
+        so rebuilds read the database and replace the file one at a time
+        """
+        fd = os.open(f'{self.path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def read_generation(fd):
+        data = os.pread(fd, ITEM.size, 0)
+        return ITEM.unpack(data)[0] if len(data) == ITEM.size else 0
+
+    def bump_generation(self, lock_fd):
+        """
+        Tell every process that questions changed. lock_fd is the file
+        descriptor yielded by locked().
+        """
+        self.generation = self.read_generation(lock_fd) + 1
+        os.pwrite(lock_fd, ITEM.pack(self.generation), 0)
+        self.changed = False
+
+    def generation_changed(self):
+        """
+        Check whether another process bumped the write generation
+        """
+        if self.generation_fd is None:
+            try:
+                self.generation_fd = os.open(f'{self.path}.lock', os.O_RDONLY)
+            except FileNotFoundError:
+                return False
+        generation = self.read_generation(self.generation_fd)
+        if generation == self.generation:
+            return False
+        self.generation = generation
+        return True
+
+    def build(self, categories, questions):
+        """
+        Write the snapshot file from categories and questions and map it.
+        Should be called while holding locked(), with data read after
+        the lock was taken.
+        """
+        questions = sorted(questions, key=lambda question: question.id)
+        category_questions = {}
+        offsets = [0]
+        body = bytearray()
+        for question in questions:
+            body += json.dumps(question.format(),
+                               separators=(',', ':')).encode('utf-8')
+            offsets.append(len(body))
+            if question.category is not None:
+                category_questions.setdefault(
+                    int(question.category), []).append(question.id)
+
+        category_ids = sorted(category_questions)
+        category_starts = [0]
+        grouped_ids = []
+        for category_id in category_ids:
+            grouped_ids += category_questions[category_id]
+            category_starts.append(len(grouped_ids))
+
+        category_map = json.dumps({category.id: category.type
+                                   for category in categories}).encode('utf-8')
+
+        def pack(values):
+            return b''.join(ITEM.pack(value) for value in values)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=f'{os.path.basename(self.path)}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, len(questions), len(category_ids),
+                                    len(category_map)))
+                f.write(pack(question.id for question in questions))
+                f.write(pack(offsets))
+                f.write(pack(category_ids))
+                f.write(pack(category_starts))
+                f.write(pack(grouped_ids))
+                f.write(category_map)
+                f.write(b'\0' * (-len(category_map) % ITEM.size))
+                f.write(body)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.stale = False
+        self.load()
+
+    def discard(self):
+        """
+        Remove the snapshot so every process falls back to the database
+        until it is rebuilt. Should be called while holding locked(), so
+        a snapshot just rebuilt by another process isn't removed.
+        """
+        self.state = None
+        self.file_id = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, questions, categories, map_size = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a trivia snapshot')
+
+        view = memoryview(buffer)
+        position = HEADER.size
+
+        def array(length):
+            nonlocal position
+            start = position
+            position += length * ITEM.size
+            return view[start:position].cast('q')
+
+        question_ids = array(questions)
+        offsets = array(questions + 1)
+        category_ids = array(categories)
+        category_starts = array(categories + 1)
+        grouped_ids = array(category_starts[-1])
+        category_map = json.loads(bytes(view[position:position + map_size]))
+        position += map_size + (-map_size % ITEM.size)
+
+        # Readers take a reference to the whole state, so a concurrent
+        # reload never closes a mapping that is still being read
+        self.state = (category_map, question_ids, offsets, category_ids,
+                      category_starts, grouped_ids, view[position:])
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+
+    def refresh(self):
+        """
+        Map the snapshot again if another process replaced or removed it.
+        Returns True when another process wrote questions or the snapshot
+        changed.
+        """
+        if self.path is None:
+            return False
+        changed = self.generation_changed()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.state is None:
+                return changed
+            self.state = None
+            self.file_id = None
+            return True
+        if (stat.st_ino, stat.st_mtime_ns) == self.file_id:
+            return changed
+        self.load()
+        return True
+
+    @property
+    def ready(self):
+        return self.state is not None and not self.stale
+
+    def categories(self):
+        return self.state[0]
+
+    def question_ids(self, category):
+        """
+        Get the ids of the questions in category, or of all questions
+        when category is 0, as a read-only sequence of ints
+        """
+        _, question_ids, _, category_ids, category_starts, grouped_ids, _ = \
+            self.state
+        category = int(category)
+        if category == 0:
+            return question_ids
+        index = bisect.bisect_left(category_ids, category)
+        if index == len(category_ids) or category_ids[index] != category:
+            return []
+        return grouped_ids[category_starts[index]:category_starts[index + 1]]
+
+    def question_json(self, question_id):
+        """
+        Get the pre-serialized JSON of a question, or None if it is missing
+        """
+        _, question_ids, offsets, _, _, _, body = self.state
+        index = bisect.bisect_left(question_ids, question_id)
+        if index == len(question_ids) or question_ids[index] != question_id:
+            return None
+        return bytes(body[offsets[index]:offsets[index + 1]])
+
+
+snapshot = Snapshot()
@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+
+# Production server: `gunicorn app:app` from the backend folder.
+# The app is created once in the master process, which warms the snapshot
+# before the workers are forked, so they share it and start warm.
+# The snapshot lives in this deployment's instance folder rather than the
+# shared temp folder, so deployments on one host don't overwrite each other.
+instance_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'instance')
+os.makedirs(instance_path, mode=0o700, exist_ok=True)
+os.environ.setdefault('SNAPSHOT_PATH',
+                      os.path.join(instance_path, 'trivia.snapshot'))
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+
+
+def post_fork(server, worker):
+    """
+    Drop the database connections inherited from the master process
+    """
+    from app import app
+    from flaskr.models import db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,480 @@
+"""
+Load and soak test of the quiz flow against a disposable local database.
+
+    python loadtest.py --stages 10:30 50:30 200:60 --max-p95-ms 250
+
+The app is served the way it runs in production: `gunicorn app:app` with
+gunicorn.conf.py, pre-forked workers and the shared snapshot. Each stage
+runs CONCURRENCY simulated players for SECONDS, spread over client
+processes so they don't share an interpreter with each other or with the
+server. A player loads the categories, picks one and plays a quiz with
+POST /quizzes, sending the growing list of previous questions, with
+searches in between. A soak test is a single long stage, e.g.
+--stages 100:3600. For numbers comparable to production, run it on a
+machine with spare cores for the clients.
+
+Unless --database is given, a database named trivia_load_<pid> is
+created on the LOAD_* server (see flaskr/config.py), filled from
+trivia.psql and dropped at the end. Database connections are sampled
+from pg_stat_activity. The exit status is 1 when a stage breaks one of
+the --max-*/--min-* thresholds.
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+from flaskr.config import get_database_path
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+SEARCH_TERMS = ['what', 'title', 'who', 'which', 'largest', 'first', 'name']
+# a search without matches is a valid 404, anything else must succeed
+OK_STATUSES = {'POST /questions/search': {200, 404}}
+DEFAULT_OK_STATUSES = {200}
+# how often client processes send their records
+FLUSH_INTERVAL = 0.2
+
+
+def run_psql_tool(tool, *args):
+    env = dict(os.environ, PGPASSWORD=os.environ.get('LOAD_PASSWORD',
+                                                     'postgres'))
+    command = [tool,
+               '-h', os.environ.get('LOAD_HOST', 'localhost'),
+               '-p', os.environ.get('LOAD_PORT', '5432'),
+               '-U', os.environ.get('LOAD_USER', 'postgres'), *args]
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def create_database(name):
+    """
+    Create the disposable database and load trivia.psql into it
+    """
+    run_psql_tool('createdb', name)
+    run_psql_tool('psql', '-q', '-v', 'ON_ERROR_STOP=1', '-d', name,
+                  '-f', os.path.join(BASEDIR, 'trivia.psql'))
+
+
+def drop_database(name):
+    run_psql_tool('dropdb', '--if-exists', name)
+
+
+def load_database_path(name):
+    os.environ['LOAD_DATABASE'] = name
+    return get_database_path('LOAD')
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Aggregate:
+    """
+    Latencies and errors of a group of requests, accumulated as their
+    records are drained
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.first_end = None
+        self.last_end = None
+
+    def add(self, record):
+        end, _, _, latency, ok = record
+        self.latencies.append(latency * 1000)
+        self.errors += not ok
+        if self.first_end is None or end < self.first_end:
+            self.first_end = end
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+
+    def summarize(self, duration):
+        requests = len(self.latencies)
+        self.latencies.sort()
+        return {
+            'requests': requests,
+            'throughput': requests / duration if duration else 0.0,
+            'p50_ms': percentile(self.latencies, 50),
+            'p95_ms': percentile(self.latencies, 95),
+            'p99_ms': percentile(self.latencies, 99),
+            'error_rate': self.errors / requests if requests else 0.0
+        }
+
+
+class Player(threading.Thread):
+    """
+    A simulated player repeatedly playing quizzes until deadline
+    """
+
+    def __init__(self, port, stage, deadline, quiz_length, search_ratio,
+                 records):
+        super().__init__(daemon=True)
+        self.port = port
+        self.stage = stage
+        self.deadline = deadline
+        self.quiz_length = quiz_length
+        self.search_ratio = search_ratio
+        self.records = records
+
+    def request(self, method, path, body=None):
+        start = time.monotonic()
+        status, data = None, None
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                    timeout=30)
+            headers = {'Content-Type': 'application/json'} if body else {}
+            connection.request(method, path,
+                               json.dumps(body) if body else None, headers)
+            response = connection.getresponse()
+            status, data = response.status, response.read()
+            connection.close()
+        except (OSError, http.client.HTTPException):
+            pass
+        end = time.monotonic()
+        endpoint = f"{method} {path.split('?')[0]}"
+        ok = status in OK_STATUSES.get(endpoint, DEFAULT_OK_STATUSES)
+        # list.append is atomic, the client process drains the list
+        self.records.append((end, self.stage, endpoint, end - start, ok))
+        if status == 200:
+            return json.loads(data)
+        return None
+
+    def play_quiz(self):
+        categories = self.request('GET', '/categories')
+        category_ids = list(categories['categories']) if categories else []
+        category = random.choice(category_ids + [0])
+
+        previous_questions = []
+        for _ in range(self.quiz_length):
+            if time.monotonic() >= self.deadline:
+                return
+            if random.random() < self.search_ratio:
+                self.request('POST', '/questions/search',
+                             {'searchTerm': random.choice(SEARCH_TERMS)})
+            quiz = self.request('POST', '/quizzes', {
+                'previous_questions': previous_questions,
+                'quiz_category': {'id': int(category)}
+            })
+            if quiz is None or 'question' not in quiz:
+                return
+            previous_questions.append(quiz['question']['id'])
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            self.play_quiz()
+
+
+def run_players(port, stage, players, deadline, quiz_length, search_ratio,
+                results):
+    """
+    Client process: run players threads until deadline, sending their
+    records to results in batches
+    """
+    records = []
+    threads = [Player(port, stage, deadline, quiz_length, search_ratio,
+                      records) for _ in range(players)]
+    for thread in threads:
+        thread.start()
+    while True:
+        alive = any(thread.is_alive() for thread in threads)
+        # players keep appending, so only remove what was copied
+        batch = records[:]
+        del records[:len(batch)]
+        if batch:
+            results.put(batch)
+        if not alive:
+            return
+        time.sleep(FLUSH_INTERVAL)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_env(database_url, snapshot_path, workers):
+    """
+    Environment making `gunicorn app:app` use database_url
+    """
+    url = make_url(database_url)
+    env = dict(os.environ, SNAPSHOT_PATH=snapshot_path)
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+    for key, value in [('HOST', url.host), ('PORT', url.port),
+                       ('USER', url.username), ('PASSWORD', url.password),
+                       ('DATABASE', url.database)]:
+        if value is not None:
+            env[f'PROD_{key}'] = str(value)
+    return env
+
+
+class LoadTest:
+    """
+    Serves the app with gunicorn and drives it through the stages
+    """
+
+    def __init__(self, database_url, workers=None, client_processes=None,
+                 quiz_length=5, search_ratio=0.2, interval=5.0,
+                 output=sys.stdout):
+        self.database_url = database_url
+        self.workers = workers
+        self.client_processes = client_processes or os.cpu_count()
+        self.quiz_length = quiz_length
+        self.search_ratio = search_ratio
+        self.interval = interval
+        self.output = output
+        # per stage, plus the records not yet sampled: a sample takes the
+        # records that ended before its window closed
+        self.stages = {}
+        self.pending = []
+        self.samples = []
+        self.monitor_engine = None
+        if database_url.startswith('postgresql'):
+            self.monitor_engine = create_engine(database_url,
+                                                poolclass=NullPool)
+
+    def database_connections(self):
+        """
+        Number of connections to the database, except this one
+        """
+        if self.monitor_engine is None:
+            return None
+        with self.monitor_engine.connect() as connection:
+            return connection.execute(text(
+                'SELECT count(*) - 1 FROM pg_stat_activity '
+                'WHERE datname = current_database()')).scalar()
+
+    def drain(self, results):
+        while True:
+            try:
+                batch = results.get_nowait()
+            except queue.Empty:
+                return
+            for record in batch:
+                self.stages.setdefault(record[1], Aggregate()).add(record)
+            self.pending += batch
+
+    def sample(self, stage, concurrency, window_start):
+        now = time.monotonic()
+        # records reach this process up to a flush late, so the window is
+        # shifted back by one flush
+        start, end = window_start - FLUSH_INTERVAL, now - FLUSH_INTERVAL
+        window = Aggregate()
+        pending = []
+        for record in self.pending:
+            if record[0] >= end:
+                pending.append(record)
+            elif record[0] >= start:
+                window.add(record)
+        self.pending = pending
+        summary = window.summarize(end - start)
+        sample = dict(summary, time=now - self.started, stage=stage,
+                      concurrency=concurrency,
+                      db_connections=self.database_connections())
+        self.samples.append(sample)
+        print(f"{sample['time']:7.1f}s {concurrency:>6} players "
+              f"{sample['throughput']:8.1f} req/s "
+              f"p95 {sample['p95_ms']:7.1f}ms "
+              f"errors {sample['error_rate']:6.2%} "
+              f"db connections {sample['db_connections']}",
+              file=self.output, flush=True)
+
+    def start_server(self, snapshot_dir):
+        self.port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+             '--bind', f'127.0.0.1:{self.port}', '--log-level', 'warning',
+             'app:app'],
+            cwd=BASEDIR,
+            env=server_env(self.database_url,
+                           os.path.join(snapshot_dir, 'trivia.snapshot'),
+                           self.workers))
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited during startup')
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1',
+                                                        self.port)
+                connection.request('GET', '/categories')
+                if connection.getresponse().status == 200:
+                    return server
+            except OSError:
+                pass
+            time.sleep(0.2)
+        server.terminate()
+        server.wait()
+        raise RuntimeError('gunicorn did not start')
+
+    def run_stage(self, stage, concurrency, seconds, results):
+        """
+        Run one stage; its client processes are joined before returning,
+        so no player of this stage is left running during the next one
+        """
+        processes = min(self.client_processes, concurrency)
+        stage_start = time.monotonic()
+        stage_end = stage_start + seconds
+        clients = [multiprocessing.Process(
+            target=run_players,
+            args=(self.port, stage,
+                  concurrency // processes + (i < concurrency % processes),
+                  stage_end, self.quiz_length, self.search_ratio, results))
+            for i in range(processes)]
+        for client in clients:
+            client.start()
+
+        while time.monotonic() < stage_end:
+            window_start = time.monotonic()
+            time.sleep(min(self.interval, max(stage_end - window_start, 0)))
+            self.drain(results)
+            self.sample(stage, concurrency, window_start)
+
+        # players finish the request they're in before exiting
+        while any(client.is_alive() for client in clients):
+            self.drain(results)
+            time.sleep(0.1)
+        for client in clients:
+            client.join()
+        self.drain(results)
+        # records of this stage that no sample covered
+        self.pending = []
+
+        requests = self.stages.setdefault(stage, Aggregate())
+        return dict(requests.summarize(time.monotonic() - stage_start),
+                    stage=stage, concurrency=concurrency, seconds=seconds,
+                    max_db_connections=max(
+                        (s['db_connections'] or 0 for s in self.samples
+                         if s['stage'] == stage), default=0))
+
+    def run(self, stages):
+        """
+        Run the (concurrency, seconds) stages, return a summary per stage
+        """
+        results = multiprocessing.Queue()
+        stage_results = []
+        # a snapshot of its own, so a live server on this host isn't affected
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            server = self.start_server(snapshot_dir)
+            self.started = time.monotonic()
+            try:
+                for stage, (concurrency, seconds) in enumerate(stages):
+                    stage_results.append(self.run_stage(
+                        stage, concurrency, seconds, results))
+            finally:
+                server.terminate()
+                server.wait()
+        return stage_results
+
+
+def check_slo(results, max_p95_ms=None, max_p99_ms=None,
+              max_error_rate=None, min_throughput=None):
+    """
+    Get a description of every threshold broken by a stage
+    """
+    checks = [('p95_ms', max_p95_ms, max), ('p99_ms', max_p99_ms, max),
+              ('error_rate', max_error_rate, max),
+              ('throughput', min_throughput, min)]
+    violations = []
+    for result in results:
+        for key, threshold, kind in checks:
+            if threshold is None:
+                continue
+            value = result[key]
+            if (value > threshold if kind is max else value < threshold):
+                violations.append(
+                    f"stage {result['stage']} ({result['concurrency']} "
+                    f"players): {key} {value:.3f} "
+                    f"{'>' if kind is max else '<'} {threshold}")
+    return violations
+
+
+def parse_stage(value):
+    concurrency, seconds = value.split(':')
+    return int(concurrency), float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__)
+    parser.add_argument('--stages', type=parse_stage, nargs='+',
+                        default=[(10, 30), (50, 30), (100, 30), (200, 30)],
+                        metavar='CONCURRENCY:SECONDS')
+    parser.add_argument('--database',
+                        help='use this database on the LOAD_* server '
+                             'instead of a disposable one')
+    parser.add_argument('--workers', type=int,
+                        help='gunicorn workers, WEB_CONCURRENCY by default')
+    parser.add_argument('--client-processes', type=int,
+                        help='processes running the players, one per CPU '
+                             'by default')
+    parser.add_argument('--quiz-length', type=int, default=5)
+    parser.add_argument('--search-ratio', type=float, default=0.2)
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between samples')
+    parser.add_argument('--report', help='write results as JSON to this file')
+    parser.add_argument('--max-p95-ms', type=float)
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--max-error-rate', type=float)
+    parser.add_argument('--min-throughput', type=float)
+    args = parser.parse_args()
+
+    database_name = args.database
+    disposable = database_name is None
+    if disposable:
+        database_name = f'trivia_load_{os.getpid()}'
+
+    try:
+        if disposable:
+            create_database(database_name)
+        load_test = LoadTest(load_database_path(database_name), args.workers,
+                             args.client_processes, args.quiz_length,
+                             args.search_ratio, args.interval)
+        results = load_test.run(args.stages)
+    finally:
+        if disposable:
+            drop_database(database_name)
+
+    print(f"\n{'stage':>5} {'players':>7} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'max db':>7}")
+    for r in results:
+        print(f"{r['stage']:>5} {r['concurrency']:>7} {r['throughput']:>8.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['error_rate']:>7.2%} {r['max_db_connections']:>7}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'stages': results, 'samples': load_test.samples}, f,
+                      indent=2)
+
+    violations = check_slo(results, args.max_p95_ms, args.max_p99_ms,
+                           args.max_error_rate, args.min_throughput)
+    for violation in violations:
+        print(f'SLO violated: {violation}')
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()